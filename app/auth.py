@@ -1,11 +1,17 @@
 from datetime import datetime, timedelta
 from typing import Optional
+from cachetools import TTLCache, cached
 from jose import JWTError, jwt
 from passlib.context import CryptContext
+import bcrypt
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from pymongo import MongoClient
+from bson import ObjectId
+from app.db import users_collection
+import hashlib
 import os
+import threading
+import time
 
 # Configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
@@ -13,28 +19,35 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 STORAGE_LIMIT_GB = 1
 STORAGE_LIMIT_BYTES = STORAGE_LIMIT_GB * 1024 * 1024 * 1024  # 1GB in bytes
+BCRYPT_COST = int(os.getenv("BCRYPT_COST", "10"))
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_COST)
+# Always use the native bcrypt extension instead of passlib's slower fallbacks
+pwd_context.handler("bcrypt").set_backend("bcrypt")
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
-# MongoDB connection
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongodb:27017/")
-DB_NAME = os.getenv("DB_NAME", "bucket_service")
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-users_collection = db["users"]
+# Decoded token cache: token hash -> (payload, user)
+_token_cache = TTLCache(maxsize=10000, ttl=30)
+_token_cache_lock = threading.Lock()
 
-# Create unique index on username
-users_collection.create_index("username", unique=True)
-users_collection.create_index("email", unique=True)
+# User lookup caches; cached documents are shared and must be treated as read-only
+_user_cache = TTLCache(maxsize=5000, ttl=60)
+_user_id_cache = TTLCache(maxsize=5000, ttl=60)
+_user_cache_lock = threading.Lock()
+
+# Fields needed by authentication and the endpoints that use the current user
+USER_PROJECTION = {
+    "username": 1, "email": 1, "hashed_password": 1, "is_admin": 1, "full_name": 1
+}
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+    # Stored hashes are all bcrypt, so skip passlib's scheme dispatch and call the backend directly
+    return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("ascii"))
 
 
 def get_password_hash(password: str) -> str:
@@ -54,9 +67,10 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
+@cached(_user_cache, key=lambda username: username, lock=_user_cache_lock)
 def get_user_by_username(username: str):
     """Get user by username"""
-    return users_collection.find_one({"username": username})
+    return users_collection.find_one({"username": username}, USER_PROJECTION)
 
 
 def get_user_by_email(email: str):
@@ -64,15 +78,21 @@ def get_user_by_email(email: str):
     return users_collection.find_one({"email": email})
 
 
+@cached(_user_id_cache, key=lambda user_id: str(user_id), lock=_user_cache_lock)
 def get_user_by_id(user_id: str):
     """Get user by ID"""
-    from bson import ObjectId
     try:
-        return users_collection.find_one({"_id": ObjectId(user_id)})
+        return users_collection.find_one({"_id": ObjectId(user_id)}, USER_PROJECTION)
     except:
         return None
 
 
+def invalidate_user_cache(username: str):
+    """Drop a cached lookup (including a cached miss) for a username"""
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
+
+
 def authenticate_user(username: str, password: str):
     """Authenticate a user"""
     user = get_user_by_username(username)
@@ -83,24 +103,44 @@ def authenticate_user(username: str, password: str):
     return user
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    """Get current authenticated user from JWT token"""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+def get_user_from_token(token: str):
+    """Resolve a JWT token to its user, or None if the token is invalid"""
+    key = hashlib.sha256(token.encode()).hexdigest()[:32]
+    with _token_cache_lock:
+        entry = _token_cache.get(key)
+    if entry is not None:
+        payload, user = entry
+        if payload.get("exp", 0) > time.time():
+            return user
+        with _token_cache_lock:
+            _token_cache.pop(key, None)
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
     except JWTError:
-        raise credentials_exception
+        return None
+    username: str = payload.get("sub")
+    if username is None:
+        return None
     
     user = get_user_by_username(username)
     if user is None:
-        raise credentials_exception
+        return None
+
+    with _token_cache_lock:
+        _token_cache[key] = (payload, user)
+    return user
+
+
+def get_current_user(token: str = Depends(oauth2_scheme)):
+    """Get current authenticated user from JWT token"""
+    user = get_user_from_token(token)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
 
@@ -114,23 +154,8 @@ def get_current_admin_user(current_user: dict = Depends(get_current_user)):
     return current_user
 
 
-def get_user_storage_usage(user_id) -> int:
-    """Calculate total storage used by a user"""
-    from bson import ObjectId
-    files_collection = db["files"]
-    # Convert to ObjectId if it's a string
-    if isinstance(user_id, str):
-        user_id = ObjectId(user_id)
-    pipeline = [
-        {"$match": {"user_id": user_id}},
-        {"$group": {"_id": None, "total_size": {"$sum": "$size"}}}
-    ]
-    result = list(files_collection.aggregate(pipeline))
-    return result[0]["total_size"] if result else 0
-
-
-def check_storage_limit(user_id, file_size: int) -> bool:
-    """Check if user can upload a file of given size"""
-    current_usage = get_user_storage_usage(user_id)
-    return (current_usage + file_size) <= STORAGE_LIMIT_BYTES
+def get_user_storage_usage(user_id: ObjectId) -> int:
+    """Get total storage used by a user from its running counter"""
+    user = users_collection.find_one({"_id": user_id}, {"storage_used": 1})
+    return user.get("storage_used", 0) if user else 0
 
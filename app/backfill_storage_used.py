@@ -0,0 +1,27 @@
+"""One-off migration: backfill the storage_used counter on user documents.
+
+Run once after upgrading, e.g. `docker-compose exec api python -m app.backfill_storage_used`
+"""
+from app.db import users_collection, files_collection
+
+
+def backfill_storage_used():
+    """Recompute storage_used for every user from the files collection"""
+    pipeline = [
+        {"$group": {"_id": "$user_id", "total_size": {"$sum": "$size"}}}
+    ]
+    usage = {doc["_id"]: doc["total_size"] for doc in files_collection.aggregate(pipeline)}
+    
+    updated = 0
+    for user in users_collection.find({}, {"_id": 1}):
+        users_collection.update_one(
+            {"_id": user["_id"]},
+            {"$set": {"storage_used": usage.get(user["_id"], 0)}}
+        )
+        updated += 1
+    return updated
+
+
+if __name__ == "__main__":
+    count = backfill_storage_used()
+    print(f"Backfilled storage_used for {count} users")
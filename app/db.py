@@ -0,0 +1,25 @@
+from pymongo import ASCENDING, IndexModel, MongoClient
+import os
+
+# MongoDB connection shared by all modules
+MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongodb:27017/")
+DB_NAME = os.getenv("DB_NAME", "bucket_service")
+client = MongoClient(MONGO_URI, maxPoolSize=50, compressors="zstd")
+db = client[DB_NAME]
+users_collection = db["users"]
+buckets_collection = db["buckets"]
+files_collection = db["files"]
+
+
+def ensure_indexes():
+    """Create all indexes with one createIndexes round-trip per collection"""
+    users_collection.create_indexes([
+        IndexModel([("username", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)], unique=True),
+    ])
+    buckets_collection.create_indexes([
+        IndexModel([("user_id", ASCENDING), ("name", ASCENDING)], unique=True),
+    ])
+    files_collection.create_indexes([
+        IndexModel([("bucket_id", ASCENDING), ("filename", ASCENDING)], unique=True),
+    ])
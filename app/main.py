@@ -1,24 +1,65 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Form
-from fastapi.responses import FileResponse as fastapi_file_response, HTMLResponse, FileResponse
+from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Form, Request
+from fastapi.responses import FileResponse as fastapi_file_response, HTMLResponse, FileResponse, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
 from pymongo.errors import DuplicateKeyError
-from bson import ObjectId
+from bson import ObjectId, has_c
 from typing import List, Optional
 from datetime import datetime, timedelta
+import aiofiles
+import asyncio
 import os
+import re
 import shutil
 from pathlib import Path
 import json
 
+from app.db import client, db, users_collection, buckets_collection, files_collection, ensure_indexes
 from app.auth import (
     get_password_hash, authenticate_user, create_access_token,
-    get_current_user, get_current_admin_user, get_user_storage_usage,
-    check_storage_limit, STORAGE_LIMIT_BYTES, ACCESS_TOKEN_EXPIRE_MINUTES
+    get_current_user, get_current_admin_user, get_user_from_token,
+    get_user_storage_usage, invalidate_user_cache, STORAGE_LIMIT_BYTES, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 
-app = FastAPI(title="Bucket as a Service", version="2.0.0")
+app = FastAPI(title="Bucket as a Service", version="2.0.0", default_response_class=ORJSONResponse)
+
+if not has_c():
+    print("Warning: pymongo C extensions are not available, BSON decoding will be slow")
+
+UPLOAD_PATH_RE = re.compile(r"/api/buckets/[^/]+/files/?")
+
+
+class UploadStorageLimitMiddleware:
+    """Return 413 when an upload's Content-Length exceeds the user's remaining storage.
+
+    Plain ASGI rather than @app.middleware("http"): BaseHTTPMiddleware re-streams
+    every response body through the middleware, which would sit in front of
+    FileResponse downloads.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and UPLOAD_PATH_RE.fullmatch(scope["path"]):
+            request = Request(scope)
+            content_length = request.headers.get("content-length", "")
+            scheme, _, token = request.headers.get("authorization", "").partition(" ")
+            if content_length.isdigit() and scheme.lower() == "bearer" and token:
+                user = await asyncio.to_thread(get_user_from_token, token)
+                if user is not None:
+                    storage_used = await asyncio.to_thread(get_user_storage_usage, user["_id"])
+                    remaining = STORAGE_LIMIT_BYTES - storage_used
+                    if int(content_length) > remaining:
+                        exc = storage_limit_exceeded()
+                        response = ORJSONResponse({"detail": exc.detail}, status_code=exc.status_code)
+                        await response(scope, receive, send)
+                        return
+        await self.app(scope, receive, send)
+
+
+# Added before CORS so that CORS wraps it and the early 413 still carries the CORS headers
+app.add_middleware(UploadStorageLimitMiddleware)
 
 # Configure CORS - Allow all origins
 app.add_middleware(
@@ -31,15 +72,11 @@ app.add_middleware(
 
 # Configuration
 STORAGE_PATH = os.getenv("STORAGE_PATH", "/app/storage")
-MONGO_URI = os.getenv("MONGO_URI", "mongodb://mongodb:27017/")
-DB_NAME = os.getenv("DB_NAME", "bucket_service")
-
-# Initialize MongoDB
-client = MongoClient(MONGO_URI)
-db = client[DB_NAME]
-buckets_collection = db["buckets"]
-files_collection = db["files"]
-users_collection = db["users"]
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+STORAGE_LIMIT_GB_F = STORAGE_LIMIT_BYTES / (1024**3)
+STORAGE_LIMIT_GB_ROUNDED = round(STORAGE_LIMIT_GB_F, 2)
+# Alphanumerics, hyphens and underscores, with at least one alphanumeric
+BUCKET_NAME_RE = re.compile(r"[_-]*[A-Za-z0-9][A-Za-z0-9_-]*")
 
 # Create storage directory
 Path(STORAGE_PATH).mkdir(parents=True, exist_ok=True)
@@ -53,19 +90,28 @@ except Exception as e:
     print(f"Warning: Could not mount static files: {e}")
 
 
+# Create database indexes on startup, before anything writes to the collections
+@app.on_event("startup")
+async def init_indexes():
+    """Create all collection indexes"""
+    ensure_indexes()
+
+
 # Initialize admin user on startup
 @app.on_event("startup")
 async def init_admin():
     """Create default admin user if it doesn't exist"""
     admin = users_collection.find_one({"username": "admin"})
     if not admin:
+        hashed_password = await asyncio.to_thread(get_password_hash, "admin123")
         users_collection.insert_one({
             "username": "admin",
             "email": "admin@example.com",
-            "hashed_password": get_password_hash("admin123"),
+            "hashed_password": hashed_password,
             "is_admin": True,
             "created_at": datetime.utcnow().isoformat(),
-            "full_name": "Administrator"
+            "full_name": "Administrator",
+            "storage_used": 0
         })
         print("Default admin user created: username=admin, password=admin123")
 
@@ -84,33 +130,33 @@ async def register(
     full_name: Optional[str] = Form(None)
 ):
     """Register a new user"""
-    # Check if username already exists
-    if users_collection.find_one({"username": username}):
-        raise HTTPException(status_code=400, detail="Username already registered")
-    
-    # Check if email already exists
-    if users_collection.find_one({"email": email}):
-        raise HTTPException(status_code=400, detail="Email already registered")
-    
-    # Create user
+    # Create user; unique indexes on username and email reject duplicates
     user_doc = {
         "username": username,
         "email": email,
-        "hashed_password": get_password_hash(password),
+        "hashed_password": await asyncio.to_thread(get_password_hash, password),
         "is_admin": False,
         "created_at": datetime.utcnow().isoformat(),
-        "full_name": full_name or username
+        "full_name": full_name or username,
+        "storage_used": 0
     }
     
     try:
         result = users_collection.insert_one(user_doc)
-        return {
-            "message": "User registered successfully",
-            "user_id": str(result.inserted_id),
-            "username": username
-        }
-    except DuplicateKeyError:
+    except DuplicateKeyError as e:
+        key_pattern = (e.details or {}).get("keyPattern", {})
+        if "username" in key_pattern:
+            raise HTTPException(status_code=400, detail="Username already registered")
+        if "email" in key_pattern:
+            raise HTTPException(status_code=400, detail="Email already registered")
         raise HTTPException(status_code=400, detail="User already exists")
+    
+    invalidate_user_cache(username)
+    return {
+        "message": "User registered successfully",
+        "user_id": str(result.inserted_id),
+        "username": username
+    }
 
 
 @app.post("/api/auth/login")
@@ -119,7 +165,7 @@ async def login(
     password: str = Form(...)
 ):
     """Login and get access token"""
-    user = authenticate_user(username, password)
+    user = await asyncio.to_thread(authenticate_user, username, password)
     if not user:
         raise HTTPException(
             status_code=401,
@@ -148,7 +194,7 @@ async def login(
 @app.get("/api/auth/me")
 async def get_current_user_info(current_user: dict = Depends(get_current_user)):
     """Get current user information"""
-    storage_used = get_user_storage_usage(str(current_user["_id"]))
+    storage_used = get_user_storage_usage(current_user["_id"])
     return {
         "id": str(current_user["_id"]),
         "username": current_user["username"],
@@ -158,7 +204,7 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
         "storage_used": storage_used,
         "storage_limit": STORAGE_LIMIT_BYTES,
         "storage_used_gb": round(storage_used / (1024**3), 2),
-        "storage_limit_gb": STORAGE_LIMIT_BYTES / (1024**3)
+        "storage_limit_gb": STORAGE_LIMIT_GB_F
     }
 
 
@@ -168,7 +214,7 @@ async def list_all_users(current_user: dict = Depends(get_current_admin_user)):
     """List all users (admin only)"""
     users = []
     for user in users_collection.find({}, {"hashed_password": 0}):
-        storage_used = get_user_storage_usage(str(user["_id"]))
+        storage_used = user.get("storage_used", 0)
         users.append({
             "id": str(user["_id"]),
             "username": user["username"],
@@ -179,25 +225,31 @@ async def list_all_users(current_user: dict = Depends(get_current_admin_user)):
             "storage_used": storage_used,
             "storage_limit": STORAGE_LIMIT_BYTES,
             "storage_used_gb": round(storage_used / (1024**3), 2),
-            "storage_limit_gb": round(STORAGE_LIMIT_BYTES / (1024**3), 2),
+            "storage_limit_gb": STORAGE_LIMIT_GB_ROUNDED,
             "storage_percentage": round((storage_used / STORAGE_LIMIT_BYTES) * 100, 2)
         })
     return {"users": users, "count": len(users)}
 
 
-@app.get("/api/admin/stats")
-async def get_admin_stats(current_user: dict = Depends(get_current_admin_user)):
-    """Get admin statistics"""
-    total_users = users_collection.count_documents({})
-    total_buckets = buckets_collection.count_documents({})
-    total_files = files_collection.count_documents({})
-    
-    # Calculate total storage used
+def get_total_storage():
+    """Calculate total storage used across all files"""
     pipeline = [
         {"$group": {"_id": None, "total_size": {"$sum": "$size"}}}
     ]
     result = list(files_collection.aggregate(pipeline))
-    total_storage = result[0]["total_size"] if result else 0
+    return result[0]["total_size"] if result else 0
+
+
+@app.get("/api/admin/stats")
+async def get_admin_stats(current_user: dict = Depends(get_current_admin_user)):
+    """Get admin statistics"""
+    # Run the per-collection queries concurrently; unfiltered totals come from collection metadata
+    total_users, total_buckets, total_files, total_storage = await asyncio.gather(
+        asyncio.to_thread(users_collection.estimated_document_count),
+        asyncio.to_thread(buckets_collection.estimated_document_count),
+        asyncio.to_thread(files_collection.estimated_document_count),
+        asyncio.to_thread(get_total_storage)
+    )
     
     return {
         "total_users": total_users,
@@ -240,7 +292,7 @@ async def create_bucket(
         raise HTTPException(status_code=400, detail="Bucket name is required")
     
     # Validate bucket name
-    if not name.replace("-", "").replace("_", "").isalnum():
+    if not BUCKET_NAME_RE.fullmatch(name):
         raise HTTPException(
             status_code=400,
             detail="Bucket name can only contain alphanumeric characters, hyphens, and underscores"
@@ -249,27 +301,25 @@ async def create_bucket(
     user_id = current_user["_id"]
     bucket_path = os.path.join(STORAGE_PATH, str(user_id), name)
     
-    # Check if bucket already exists for this user
-    existing = buckets_collection.find_one({"name": name, "user_id": user_id})
-    if existing:
+    # Create bucket document; the unique (user_id, name) index rejects duplicates
+    bucket_doc = {
+        "name": name,
+        "description": description,
+        "user_id": user_id,
+        "created_at": datetime.utcnow().isoformat(),
+        "file_count": 0,
+        "total_size": 0
+    }
+    
+    try:
+        result = buckets_collection.insert_one(bucket_doc)
+    except DuplicateKeyError:
         raise HTTPException(status_code=409, detail="Bucket already exists")
     
     try:
         # Create bucket directory
         os.makedirs(bucket_path, exist_ok=False)
         
-        # Create bucket document
-        bucket_doc = {
-            "name": name,
-            "description": description,
-            "user_id": user_id,
-            "created_at": datetime.utcnow().isoformat(),
-            "file_count": 0,
-            "total_size": 0
-        }
-        
-        result = buckets_collection.insert_one(bucket_doc)
-        
         return {
             "id": str(result.inserted_id),
             "name": name,
@@ -280,6 +330,7 @@ async def create_bucket(
             "message": "Bucket created successfully"
         }
     except Exception as e:
+        buckets_collection.delete_one({"_id": result.inserted_id})
         if os.path.exists(bucket_path):
             shutil.rmtree(bucket_path)
         raise HTTPException(status_code=500, detail=f"Error creating bucket: {str(e)}")
@@ -290,7 +341,8 @@ async def list_buckets(current_user: dict = Depends(get_current_user)):
     """List all buckets for current user"""
     user_id = current_user["_id"]
     buckets = []
-    for bucket in buckets_collection.find({"user_id": user_id}):
+    projection = {"name": 1, "description": 1, "created_at": 1, "file_count": 1, "total_size": 1}
+    for bucket in buckets_collection.find({"user_id": user_id}, projection):
         buckets.append({
             "id": str(bucket["_id"]),
             "name": bucket["name"],
@@ -338,22 +390,44 @@ async def delete_bucket(
     bucket_path = os.path.join(STORAGE_PATH, str(user_id), bucket_name)
     
     try:
+        # Delete bucket directory first, without blocking the event loop, so a
+        # failure leaves the file documents and storage counter in step
+        if os.path.exists(bucket_path):
+            await asyncio.to_thread(shutil.rmtree, bucket_path)
+        
+        # Sum the sizes of the files being deleted
+        pipeline = [
+            {"$match": {"bucket_id": bucket_id}},
+            {"$group": {"_id": None, "total_size": {"$sum": "$size"}}}
+        ]
+        bucket_size = next(files_collection.aggregate(pipeline), {"total_size": 0})["total_size"]
+        
         # Delete all files from database
         files_collection.delete_many({"bucket_id": bucket_id})
         
-        # Delete bucket directory
-        if os.path.exists(bucket_path):
-            shutil.rmtree(bucket_path)
-        
         # Delete bucket from database
         buckets_collection.delete_one({"_id": bucket_id})
         
+        # Update user storage usage
+        users_collection.update_one(
+            {"_id": user_id},
+            {"$inc": {"storage_used": -bucket_size}}
+        )
+        
         return {"message": f"Bucket '{bucket_name}' deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting bucket: {str(e)}")
 
 
 # File Operations (Protected)
+def storage_limit_exceeded() -> HTTPException:
+    """Error raised when an upload would exceed the user's storage limit"""
+    return HTTPException(
+        status_code=413,
+        detail=f"Storage limit exceeded. You have {STORAGE_LIMIT_GB_F:.2f}GB limit."
+    )
+
+
 @app.post("/api/buckets/{bucket_name}/files")
 async def upload_file(
     bucket_name: str,
@@ -366,16 +440,8 @@ async def upload_file(
     if not bucket:
         raise HTTPException(status_code=404, detail="Bucket not found")
     
-    # Read file size first
-    file_content = await file.read()
-    file_size = len(file_content)
-    
-    # Check storage limit
-    if not check_storage_limit(str(user_id), file_size):
-        raise HTTPException(
-            status_code=413,
-            detail=f"Storage limit exceeded. You have {STORAGE_LIMIT_BYTES / (1024**3):.2f}GB limit."
-        )
+    # Oversized requests are rejected by middleware; enforce the exact limit while streaming
+    remaining = STORAGE_LIMIT_BYTES - get_user_storage_usage(user_id)
     
     bucket_id = bucket["_id"]
     bucket_path = os.path.join(STORAGE_PATH, str(user_id), bucket_name)
@@ -383,14 +449,16 @@ async def upload_file(
     # Save file
     file_path = os.path.join(bucket_path, file.filename)
     
-    # Check if file already exists
-    if os.path.exists(file_path):
-        raise HTTPException(status_code=409, detail="File already exists")
-    
     try:
-        # Write file to disk
-        with open(file_path, "wb") as buffer:
-            buffer.write(file_content)
+        # Stream file to disk, enforcing the storage limit as we go.
+        # Exclusive create ("x") fails instead of overwriting an existing file.
+        file_size = 0
+        async with aiofiles.open(file_path, "xb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                file_size += len(chunk)
+                if file_size > remaining:
+                    raise storage_limit_exceeded()
+                await buffer.write(chunk)
         
         # Save file metadata
         file_doc = {
@@ -417,6 +485,12 @@ async def upload_file(
             }
         )
         
+        # Update user storage usage
+        users_collection.update_one(
+            {"_id": user_id},
+            {"$inc": {"storage_used": file_size}}
+        )
+        
         return {
             "id": str(result.inserted_id),
             "filename": file.filename,
@@ -426,6 +500,12 @@ async def upload_file(
             "uploaded_at": file_doc["uploaded_at"],
             "message": "File uploaded successfully"
         }
+    except FileExistsError:
+        raise HTTPException(status_code=409, detail="File already exists")
+    except HTTPException:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        raise
     except Exception as e:
         if os.path.exists(file_path):
             os.remove(file_path)
@@ -446,7 +526,8 @@ async def list_files(
     bucket_id = bucket["_id"]
     files = []
     
-    for file in files_collection.find({"bucket_id": bucket_id}):
+    projection = {"filename": 1, "size": 1, "content_type": 1, "uploaded_at": 1}
+    for file in files_collection.find({"bucket_id": bucket_id}, projection):
         files.append({
             "id": str(file["_id"]),
             "filename": file["filename"],
@@ -531,6 +612,12 @@ async def delete_file(
             }
         )
         
+        # Update user storage usage
+        users_collection.update_one(
+            {"_id": user_id},
+            {"$inc": {"storage_used": -file_size}}
+        )
+        
         return {"message": f"File '{filename}' deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error deleting file: {str(e)}")